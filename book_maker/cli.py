@@ -349,6 +349,12 @@ So you are close to reaching the limit. You have to choose your own value, there
         action="store_true",
         help="adds an additional paragraph for global, updating historical context of the story to the model's input, improving the narrative consistency for the AI model (this uses ~200 more tokens each time)",
     )
+    parser.add_argument(
+        "--use_cache",
+        dest="cache_flag",
+        action="store_true",
+        help="reuse translations of identical paragraphs from earlier runs and chapters, stored in ~/.cache/bilingual_book_maker/translations.db (currently only supported for ChatGPT models, ignored with --use_context)",
+    )
     parser.add_argument(
         "--context_paragraph_limit",
         dest="context_paragraph_limit",
@@ -398,6 +404,18 @@ So you are close to reaching the limit. You have to choose your own value, there
         default=0.01,
         help="Request interval in seconds (e.g., 0.1 for 100ms). Currently only supported for Gemini models. Default: 0.01",
     )
+    parser.add_argument(
+        "--rpm",
+        type=int,
+        default=0,
+        help="Requests per minute allowed by your API account, shared by all workers. Currently only supported for ChatGPT models. Default: 0 (unlimited)",
+    )
+    parser.add_argument(
+        "--tpm",
+        type=int,
+        default=0,
+        help="Prompt tokens per minute allowed by your API account, shared by all workers. Currently only supported for ChatGPT models. Default: 0 (unlimited)",
+    )
     parser.add_argument(
         "--parallel-workers",
         dest="parallel_workers",
@@ -606,6 +624,11 @@ So you are close to reaching the limit. You have to choose your own value, there
     if options.batch_use_flag:
         e.batch_use_flag = options.batch_use_flag
 
+    if options.cache_flag and hasattr(e.translate_model, "set_translation_cache"):
+        e.translate_model.set_translation_cache()
+    if (options.rpm or options.tpm) and hasattr(e.translate_model, "set_rate_limit"):
+        e.translate_model.set_rate_limit(options.rpm, options.tpm)
+
     if options.model in ("gemini", "geminipro"):
         e.translate_model.set_interval(options.interval)
     if options.model == "gemini":
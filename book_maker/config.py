@@ -3,6 +3,9 @@ config = {
         "chatgptapi": {
             "context_paragraph_limit": 3,
             "batch_context_update_interval": 50,
+            # seconds between batch status checks, batches have a 24h window
+            "batch_poll_interval": 30,
+            "batch_wait_timeout": 24 * 60 * 60,
         }
     },
 }
@@ -16,7 +16,12 @@ from ebooklib import ITEM_DOCUMENT, epub
 from rich import print
 from tqdm import tqdm
 
-from book_maker.utils import num_tokens_from_text, prompt_config_to_kwargs
+from book_maker.config import config
+from book_maker.utils import (
+    get_file_logger,
+    num_tokens_from_text,
+    prompt_config_to_kwargs,
+)
 
 from .base_loader import BaseBookLoader
 from .helper import EPUBBookLoaderHelper, is_text_link, not_trans
@@ -275,6 +280,8 @@ class EPUBBookLoader(BaseBookLoader):
         return index
 
     def translate_paragraphs_acc(self, p_list, send_num):
+        # every list sent to translate_list below stays under send_num tokens
+        self.translate_model.accumulated_num = send_num
         count = 0
         wait_p_list = []
         for i in range(len(p_list)):
@@ -484,8 +491,9 @@ class EPUBBookLoader(BaseBookLoader):
 
         send_num = self.accumulated_num
         if send_num > 1:
-            with open("log/buglog.txt", "a") as f:
-                print(f"------------- {item.file_name} -------------", file=f)
+            get_file_logger("log/buglog.txt").info(
+                f"------------- {item.file_name} -------------"
+            )
 
             print("------------------------------------------------------")
             print(f"dealing {item.file_name} ...")
@@ -558,6 +566,29 @@ class EPUBBookLoader(BaseBookLoader):
             self._translation_index += 1
             return index
 
+    def _process_chapters_parallel(self, chapter_data_list, workers, chapter_pbar):
+        """Process chapters on workers threads, return their items in book order."""
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            future_to_item = {
+                executor.submit(
+                    self._process_chapter_parallel, chapter_data
+                ): chapter_data[0]
+                for chapter_data in chapter_data_list
+            }
+
+            for future in as_completed(future_to_item):
+                item = future_to_item[future]
+                try:
+                    result = future.result()
+                    if result["success"] and result["processed_content"]:
+                        item.content = result["processed_content"]
+                    chapter_pbar.set_postfix_str(f"Latest: {item.file_name[:20]}...")
+                except Exception as e:
+                    print(f"❌ Error processing {item.file_name}: {e}")
+                chapter_pbar.update(1)
+
+        return [chapter_data[0] for chapter_data in chapter_data_list]
+
     def _process_chapter_parallel(self, chapter_data):
         """Process a single chapter in parallel mode with proper accumulated_num handling."""
         item, trans_taglist, p_to_save_len = chapter_data
@@ -692,6 +723,7 @@ class EPUBBookLoader(BaseBookLoader):
         from book_maker.utils import num_tokens_from_text
         from .helper import not_trans
 
+        translator.accumulated_num = send_num
         count = 0
         wait_p_list = []
 
@@ -812,12 +844,15 @@ class EPUBBookLoader(BaseBookLoader):
         if self.batch_flag or self.batch_use_flag:
             self.translate_model.batch_init(name)
             if self.batch_use_flag:
+                batch_config = config["translator"]["chatgptapi"]
                 start_time = time.time()
                 while not self.translate_model.is_completed_batch():
                     print("Batch translation is not completed yet")
-                    time.sleep(2)
-                    if time.time() - start_time > 300:  # 5 minutes
-                        raise Exception("Batch translation timed out after 5 minutes")
+                    if time.time() - start_time > batch_config["batch_wait_timeout"]:
+                        raise Exception(
+                            f"Batch translation timed out after {batch_config['batch_wait_timeout']} seconds"
+                        )
+                    time.sleep(batch_config["batch_poll_interval"])
 
     def make_bilingual_book(self):
         self.helper = EPUBBookLoaderHelper(
@@ -912,30 +947,11 @@ class EPUBBookLoader(BaseBookLoader):
                     (item, trans_taglist, p_to_save_len) for item in document_items
                 ]
 
-                with ThreadPoolExecutor(max_workers=effective_workers) as executor:
-                    future_to_item = {
-                        executor.submit(
-                            self._process_chapter_parallel, chapter_data
-                        ): chapter_data[0]
-                        for chapter_data in chapter_data_list
-                    }
-
-                    for future in as_completed(future_to_item):
-                        item = future_to_item[future]
-                        try:
-                            result = future.result()
-                            if result["success"] and result["processed_content"]:
-                                item.content = result["processed_content"]
-                            new_book.add_item(item)
-                            chapter_pbar.update(1)
-                            chapter_pbar.set_postfix_str(
-                                f"Latest: {item.file_name[:20]}..."
-                            )
-
-                        except Exception as e:
-                            print(f"❌ Error processing {item.file_name}: {e}")
-                            new_book.add_item(item)
-                            chapter_pbar.update(1)
+                # chapters finish in any order but are added in book order
+                for item in self._process_chapters_parallel(
+                    chapter_data_list, effective_workers, chapter_pbar
+                ):
+                    new_book.add_item(item)
 
                 chapter_pbar.close()
                 print(f"✅ Completed all {len(document_items)} chapters")
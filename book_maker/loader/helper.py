@@ -71,25 +71,30 @@ class EPUBBookLoaderHelper:
 
 
 url_pattern = r"(http[s]?://|www\.)+(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+"
+# these run on every paragraph, compile them once
+url_re = re.compile(url_pattern)
+tail_link_re = re.compile(r".*" + url_pattern + r"$")
+listing_re = re.compile(r"^Listing\s*\d+")
+figure_re = re.compile(r"^Figure\s*\d+")
+isbn_re = re.compile(r"^[Ee]?ISBN\s*\d[\d\s]*$")
 
 
 def is_text_link(text):
-    return bool(re.compile(url_pattern).match(text.strip()))
+    return bool(url_re.match(text.strip()))
 
 
 def is_text_tail_link(text, num=80):
     text = text.strip()
-    pattern = r".*" + url_pattern + r"$"
-    return bool(re.compile(pattern).match(text)) and len(text) < num
+    return bool(tail_link_re.match(text)) and len(text) < num
 
 
 def shorter_result_link(text, num=20):
-    match = re.search(url_pattern, text)
+    match = url_re.search(text)
 
     if not match or len(match.group()) < num:
         return text
 
-    return re.compile(url_pattern).sub("...", text)
+    return url_re.sub("...", text)
 
 
 def is_text_source(text):
@@ -98,12 +103,12 @@ def is_text_source(text):
 
 def is_text_list(text, num=80):
     text = text.strip()
-    return re.match(r"^Listing\s*\d+", text) and len(text) < num
+    return listing_re.match(text) and len(text) < num
 
 
 def is_text_figure(text, num=80):
     text = text.strip()
-    return re.match(r"^Figure\s*\d+", text) and len(text) < num
+    return figure_re.match(text) and len(text) < num
 
 
 def is_text_digit_and_space(s):
@@ -114,8 +119,7 @@ def is_text_digit_and_space(s):
 
 
 def is_text_isbn(s):
-    pattern = r"^[Ee]?ISBN\s*\d[\d\s]*$"
-    return bool(re.match(pattern, s))
+    return bool(isbn_re.match(s))
 
 
 def not_trans(s):
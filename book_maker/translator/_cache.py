@@ -0,0 +1,65 @@
+import hashlib
+import os
+import sqlite3
+from collections import OrderedDict
+from threading import Lock
+
+DEFAULT_CACHE_PATH = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+    "bilingual_book_maker",
+    "translations.db",
+)
+
+
+def cache_key(*parts):
+    """Hash the parts that decide a translation into a fixed size key."""
+    return hashlib.blake2b("|".join(parts).encode("utf8"), digest_size=32).hexdigest()
+
+
+class TranslationCache:
+    """Translations kept in SQLite across runs, with an in-memory LRU in front.
+
+    Chapter workers share one instance, so every access holds a lock.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, maxsize=4096):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.maxsize = maxsize
+        self._memory = OrderedDict()
+        self._lock = Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        # WAL keeps the per translation commits from waiting on a full fsync
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS translations (key TEXT PRIMARY KEY, value TEXT)"
+        )
+
+    def _remember(self, key, value):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        if len(self._memory) > self.maxsize:
+            self._memory.popitem(last=False)
+
+    def get(self, key):
+        with self._lock:
+            value = self._memory.get(key)
+            if value is not None:
+                self._memory.move_to_end(key)
+                return value
+            row = self._db.execute(
+                "SELECT value FROM translations WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._remember(key, row[0])
+            return row[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO translations (key, value) VALUES (?, ?)",
+                (key, value),
+            )
+            self._remember(key, value)
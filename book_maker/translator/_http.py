@@ -0,0 +1,138 @@
+import asyncio
+import atexit
+import json
+from os import environ
+from threading import Lock
+
+import aiohttp
+import httpx
+from openai import DefaultAsyncHttpxClient, DefaultHttpxClient
+
+OPENAI_API_BASE = "https://api.openai.com/v1"
+
+# keep idle connections (and their TLS sessions) around between requests
+HTTP_POOL_LIMITS = httpx.Limits(
+    max_connections=128, max_keepalive_connections=64, keepalive_expiry=60
+)
+
+# sdk clients are created per translator, key and azure deployment, so all of
+# the ones talking to the same base url share one connection pool
+_http_clients = {}
+_http_clients_lock = Lock()
+_async_http_clients = {}
+
+# one session for the whole process, created lazily on the background loop
+# used by utils.run_async; aiohttp sessions (and async httpx clients) are bound
+# to the loop they start on
+_session = None
+_session_loop = None
+
+
+def _get_session():
+    global _session, _session_loop
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=256, limit_per_host=128, ttl_dns_cache=600, keepalive_timeout=60
+            ),
+            # --proxy is passed on through http(s)_proxy, like the sdk clients
+            trust_env=True,
+        )
+        _session_loop = asyncio.get_running_loop()
+    return _session
+
+
+def get_http_client(base_url=None):
+    """Return the shared httpx.Client to pass as http_client to a sync sdk client."""
+    with _http_clients_lock:
+        client = _http_clients.get(base_url)
+        if client is None:
+            client = DefaultHttpxClient(limits=HTTP_POOL_LIMITS)
+            _http_clients[base_url] = client
+    return client
+
+
+def get_async_http_client(base_url=None):
+    """Like get_http_client for async sdk clients, only call it on the shared loop."""
+    global _session_loop
+    client = _async_http_clients.get(base_url)
+    if client is None:
+        client = DefaultAsyncHttpxClient(limits=HTTP_POOL_LIMITS)
+        _async_http_clients[base_url] = client
+        _session_loop = asyncio.get_running_loop()
+    return client
+
+
+async def _raise_for_status(response):
+    if response.status >= 400:
+        raise aiohttp.ClientResponseError(
+            response.request_info,
+            response.history,
+            status=response.status,
+            message=await response.text(),
+            headers=response.headers,
+        )
+
+
+def _post_chat_completion(messages, model, temperature, api_key, api_base, **body):
+    api_base = api_base or environ.get("OPENAI_BASE_URL") or OPENAI_API_BASE
+    return _get_session().post(
+        f"{api_base.rstrip('/')}/chat/completions",
+        json={
+            "model": model,
+            "messages": messages,
+            "temperature": temperature,
+            **body,
+        },
+        headers={"Authorization": f"Bearer {api_key}"},
+    )
+
+
+async def chat_completion(messages, model, temperature, api_key, api_base=None):
+    """POST to the OpenAI compatible /chat/completions endpoint, return the json."""
+    async with _post_chat_completion(
+        messages, model, temperature, api_key, api_base
+    ) as response:
+        await _raise_for_status(response)
+        return await response.json()
+
+
+async def stream_chat_completion(messages, model, temperature, api_key, api_base=None):
+    """Like chat_completion with stream=True, yield the content deltas.
+
+    Closing the generator before the reply is done drops the connection, which
+    makes the server stop generating (and billing) the rest of it.
+    """
+    async with _post_chat_completion(
+        messages, model, temperature, api_key, api_base, stream=True
+    ) as response:
+        await _raise_for_status(response)
+        try:
+            async for line in response.content:
+                if not line.startswith(b"data:"):
+                    continue
+                data = line[5:].strip()
+                if data == b"[DONE]":
+                    return
+                choices = json.loads(data).get("choices")
+                if choices and choices[0].get("delta", {}).get("content"):
+                    yield choices[0]["delta"]["content"]
+        finally:
+            if not response.content.at_eof():
+                response.close()
+
+
+@atexit.register
+def close_session():
+    for client in _http_clients.values():
+        client.close()
+    if _session_loop is None or not _session_loop.is_running():
+        return
+
+    async def close():
+        if _session is not None:
+            await _session.close()
+        for client in _async_http_clients.values():
+            await client.aclose()
+
+    asyncio.run_coroutine_threadsafe(close(), _session_loop).result(timeout=5)
@@ -0,0 +1,52 @@
+import asyncio
+import time
+
+
+class AsyncTokenBucket:
+    """Requests-per-minute and tokens-per-minute limiter for async callers.
+
+    Both buckets start full and refill continuously at rpm/60 and tpm/60 per
+    second, so concurrent requests settle at the account limits instead of
+    bursting into 429s and backing off. A limit of 0 disables that bucket.
+    clock and sleep can be swapped out to drive the bucket without waiting.
+    """
+
+    def __init__(self, rpm=0, tpm=0, clock=time.monotonic, sleep=asyncio.sleep):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._clock = clock
+        self._sleep = sleep
+        self._requests = float(rpm)
+        self._tokens = float(tpm)
+        self._updated = clock()
+        # waiters queue up on the lock, so requests are let through in order
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = self._clock()
+        elapsed = now - self._updated
+        self._updated = now
+        self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+        self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+
+    def _wait_time(self, request_cost, token_cost):
+        wait = 0
+        if self.rpm and self._requests < request_cost:
+            wait = (request_cost - self._requests) * 60 / self.rpm
+        if self.tpm and self._tokens < token_cost:
+            wait = max(wait, (token_cost - self._tokens) * 60 / self.tpm)
+        return wait
+
+    async def acquire(self, request_cost=1, token_cost=0):
+        # a single request larger than the whole bucket would wait forever
+        request_cost = min(request_cost, self.rpm)
+        token_cost = min(token_cost, self.tpm)
+        async with self._lock:
+            self._refill()
+            wait = self._wait_time(request_cost, token_cost)
+            while wait > 0:
+                await self._sleep(wait)
+                self._refill()
+                wait = self._wait_time(request_cost, token_cost)
+            self._requests -= request_cost
+            self._tokens -= token_cost
@@ -1,18 +1,49 @@
+import asyncio
+from contextlib import aclosing
+import random
 import re
 import time
 import os
 import shutil
-from copy import copy
+from functools import cached_property
 from os import environ
 from itertools import cycle
 import json
 from threading import Lock
 
-from openai import AzureOpenAI, OpenAI, RateLimitError
+import backoff
+from aiohttp import ClientConnectionError, ClientPayloadError, ClientResponseError
+from openai import (
+    APIConnectionError,
+    APITimeoutError,
+    AsyncAzureOpenAI,
+    AuthenticationError,
+    AzureOpenAI,
+    InternalServerError,
+    OpenAI,
+    PermissionDeniedError,
+    RateLimitError,
+)
 from rich import print
 
+from ._cache import DEFAULT_CACHE_PATH, TranslationCache, cache_key
+from ._http import (
+    chat_completion,
+    get_async_http_client,
+    get_http_client,
+    stream_chat_completion,
+)
+from ._ratelimit import AsyncTokenBucket
 from .base_translator import Base
 from ..config import config
+from ..utils import (
+    _get_encoding,
+    count_tokens,
+    count_tokens_batch,
+    get_file_logger,
+    process_concurrently_async,
+    run_async,
+)
 
 CHATGPT_CONFIG = config["translator"]["chatgptapi"]
 
@@ -65,9 +96,230 @@ O3MINI_MODEL_LIST = [
     "o3-mini",
 ]
 
+_JSON_DECODER = json.JSONDecoder()
+_RE_COLLAPSE_NL = re.compile(r"\n{3,}")
+_RE_NUM_PREFIX = re.compile(r"^\(\d+\)\s*")
+_RE_ITEM_NUMBER = re.compile(r"^\s*\((\d+)\)")
+_RE_DIGITS = re.compile(r"\d+")
+_RE_NUMBERED_PARAGRAPH = re.compile(r"\((\d+)\)\s*(.*?)(?=\s*\(\d+\)|\Z)", re.DOTALL)
+_RE_STRUCTURED_PARAGRAPH = re.compile(
+    r"TRANSLATION OF PARAGRAPH (\d+):(.*?)(?=TRANSLATION OF PARAGRAPH \d+:|\Z)",
+    re.DOTALL,
+)
+_RE_LOOSE_PARAGRAPH = re.compile(
+    r"(?:TRANSLATION|PARAGRAPH|PARA).*?(\d+).*?:(.*?)(?=(?:TRANSLATION|PARAGRAPH|PARA).*?\d+.*?:|\Z)",
+    re.DOTALL,
+)
+
+# azure async clients are shared by every ChatGPTAPI instance, one per key/endpoint
+_ASYNC_AZURE_CLIENTS = {}
+
+
+RETRY_MAX_TRIES = 8
+RETRY_MAX_WAIT = 60
+
+
+def is_retryable_error(e):
+    if isinstance(e, ClientResponseError):
+        return e.status == 429 or e.status >= 500
+    return isinstance(
+        e,
+        (
+            RateLimitError,
+            APIConnectionError,
+            APITimeoutError,
+            InternalServerError,
+            ClientConnectionError,
+            # the connection dropped while the (streamed) body was being read
+            ClientPayloadError,
+            asyncio.TimeoutError,
+        ),
+    )
+
+
+def is_auth_error(e):
+    if isinstance(e, ClientResponseError):
+        return e.status in (401, 403)
+    return isinstance(e, (AuthenticationError, PermissionDeniedError))
+
+
+def retry_after_seconds(e):
+    if isinstance(e, ClientResponseError):
+        headers = e.headers
+    else:
+        headers = getattr(getattr(e, "response", None), "headers", None)
+    try:
+        return float(headers["retry-after"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def wait_for_retry(key_len, max_value=RETRY_MAX_WAIT):
+    """Wait generator for backoff, which sends in the exception of every failed try.
+
+    An invalid or exhausted key (auth error) is retried at once with the next
+    key, until every key has failed. Otherwise wait for Retry-After when the
+    server sends it, else exponential backoff with full jitter so concurrent
+    workers don't retry in lockstep.
+    """
+    auth_failures = 0
+    attempt = 0
+    e = yield
+    while True:
+        if is_auth_error(e):
+            auth_failures += 1
+            if auth_failures >= key_len:
+                return
+            wait = 0
+        else:
+            wait = retry_after_seconds(e)
+            if wait is None:
+                wait = random.uniform(0, min(max_value, 2**attempt))
+            attempt += 1
+        e = yield wait
+
+
+def load_json_array(text):
+    """Parse the JSON array in a model reply, or return None.
+
+    Models sometimes wrap the array in a code fence or add a sentence around
+    it, so decode from the first "[" and ignore whatever follows the array.
+    """
+    start = text.find("[")
+    if start == -1:
+        return None
+    try:
+        result, _ = _JSON_DECODER.raw_decode(text, start)
+    except ValueError:
+        return None
+    return result
+
+
+def find_dropped_paragraph(texts, reply, result_list):
+    """Return the index of the one paragraph of texts missing from result_list.
+
+    Returns None when that is not certain: the item numbers kept in the
+    reply, the numbers inside the paragraphs (which survive translation) and
+    the translation lengths must leave a single candidate, so that a merged
+    pair of paragraphs is not mistaken for a dropped one.
+    """
+    count = len(texts)
+    if len(result_list) != count - 1:
+        return None
+
+    # the item numbers only tell which one is missing when the gap is before
+    # the end, a reply numbered 1..count-1 may as well have been renumbered
+    candidates = set(range(count))
+    items = load_json_array(reply)
+    if isinstance(items, list) and all(isinstance(item, str) for item in items):
+        matches = [_RE_ITEM_NUMBER.match(item) for item in items]
+        numbers = [int(match.group(1)) for match in matches if match]
+        if len(numbers) == len(items) and numbers == sorted(set(numbers)):
+            missing = set(range(1, count + 1)) - set(numbers)
+            if len(missing) == 1 and numbers[-1] == count:
+                candidates = {missing.pop() - 1}
+
+    # removing the dropped paragraph must make the digit runs of the sources
+    # line up with those of the translations
+    sources = [_RE_DIGITS.findall(text) for text in texts]
+    translations = [_RE_DIGITS.findall(t_text) for t_text in result_list]
+    prefix = 0
+    while prefix < count - 1 and sources[prefix] == translations[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < count - 1 and sources[-1 - suffix] == translations[-1 - suffix]:
+        suffix += 1
+    candidates &= set(range(count - 1 - suffix, prefix + 1))
+    if len(candidates) != 1:
+        return None
+    dropped = candidates.pop()
+
+    # a translation next to the gap that is much longer than usual for its
+    # source most likely took in the dropped paragraph as well
+    kept = texts[:dropped] + texts[dropped + 1 :]
+    ratios = [
+        len(t_text) / max(len(text), 1) for text, t_text in zip(kept, result_list)
+    ]
+    usual = sorted(ratios)[len(ratios) // 2]
+    if any(
+        ratios[i] > 1.5 * usual for i in (dropped - 1, dropped) if 0 <= i < len(ratios)
+    ):
+        return None
+    return dropped
+
+
+def paragraph_text(p):
+    """Return the stripped text of p without its <sup> footnote markers.
+
+    Reads the strings in place instead of copying the tag and extracting the
+    markers, which cost a full subtree clone per paragraph.
+    """
+    if p.find("sup") is None:
+        return p.get_text().strip()
+    parts = []
+    for string in p.strings:
+        parent = string.parent
+        while parent is not p and parent.name != "sup":
+            parent = parent.parent
+        if parent is p:
+            parts.append(string)
+    return "".join(parts).strip()
+
+
+class JSONArrayEnd:
+    """Find where the JSON array a streamed reply starts with ends.
+
+    Only a reply that starts with the array, optionally inside a code fence,
+    is tracked: in anything else a "]" may just be part of the prose.
+    """
+
+    def __init__(self):
+        self.prefix = ""
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+
+    def feed(self, chunk):
+        """Return the offset just past the closing "]" in chunk, or -1."""
+        if self.prefix is None:
+            return -1
+        for i, char in enumerate(chunk):
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == "[":
+                self.depth += 1
+            elif not self.depth:
+                self.prefix += char
+                if not "```json".startswith(self.prefix.strip()):
+                    self.prefix = None
+                    return -1
+            elif char == '"':
+                self.in_string = True
+            elif char == "]":
+                self.depth -= 1
+                if not self.depth:
+                    return i + 1
+        return -1
+
 
 class ChatGPTAPI(Base):
     DEFAULT_PROMPT = "Please help me to translate,`{text}` to {language}, please return only translated content not include the origin text"
+    # subclasses that bring their own client set this to False, translate_list
+    # then falls back to a single structured request through translate()
+    async_api = True
+    BATCH_PROMPT = (
+        "Translate each numbered item below to {language}. "
+        "Return only a JSON array of exactly {count} strings, the translation of "
+        "each item in the same order, each string starting with its number like (1). "
+        "The reply must be strict JSON: double quoted strings, no trailing comma, "
+        "no code fence and nothing before or after the array. "
+        "Do not merge, split or skip items.\n\n{text}"
+    )
 
     def __init__(
         self,
@@ -83,7 +335,11 @@ class ChatGPTAPI(Base):
     ) -> None:
         super().__init__(key, language)
         self.key_len = len(key.split(","))
-        self.openai_client = OpenAI(api_key=next(self.keys), base_url=api_base)
+        self.openai_client = OpenAI(
+            api_key=next(self.keys),
+            base_url=api_base,
+            http_client=get_http_client(api_base),
+        )
         self.api_base = api_base
 
         self.prompt_template = (
@@ -115,7 +371,11 @@ class ChatGPTAPI(Base):
         self.batch_text_list = []
         self.batch_info_cache = None
         self.result_content_cache = {}
+        # token bound of the lists passed to translate_list, set by the loader
+        self.accumulated_num = 0
         self._api_lock = Lock()
+        self.rate_limiter = None
+        self.translation_cache = None
 
     def rotate_key(self):
         with self._api_lock:
@@ -163,21 +423,41 @@ class ChatGPTAPI(Base):
         )
         return completion
 
+    def translation_cache_key(self, text, model):
+        return cache_key(
+            model,
+            self.language,
+            self.prompt_template,
+            self.system_content or self.prompt_sys_msg,
+            text,
+        )
+
     def get_translation(self, text):
         self.rotate_key()
         self.rotate_model()  # rotate all the model to avoid the limit
 
+        # with --use_context the translation also depends on the running context
+        use_cache = self.translation_cache is not None and not self.context_flag
+        if use_cache:
+            key = self.translation_cache_key(text, self.model)
+            t_text = self.translation_cache.get(key)
+            if t_text is not None:
+                return t_text
+
+        if self.rate_limiter:
+            # wait on the same bucket as the batched requests, on the shared loop
+            messages = self.create_messages(text, self.create_context_messages())
+            run_async(self._acquire_rate_limit(messages))
+
         completion = self.create_chat_completion(text)
 
         # TODO work well or exception finish by length limit
-        # Check if content is not None before encoding
-        if completion.choices[0].message.content is not None:
-            t_text = completion.choices[0].message.content.encode("utf8").decode() or ""
-        else:
-            t_text = ""
+        t_text = completion.choices[0].message.content or ""
 
         if self.context_flag:
             self.save_context(text, t_text)
+        elif use_cache and t_text:
+            self.translation_cache.set(key, t_text)
 
         return t_text
 
@@ -190,39 +470,39 @@ class ChatGPTAPI(Base):
                 self.context_list.pop(0)
                 self.context_translated_list.pop(0)
 
+    def retry_on_api_error(self, func):
+        return backoff.on_exception(
+            wait_for_retry,
+            Exception,
+            giveup=lambda e: not (is_retryable_error(e) or is_auth_error(e)),
+            max_tries=RETRY_MAX_TRIES,
+            jitter=None,
+            on_backoff=lambda details: print(
+                details["exception"], f"will sleep {details['wait']:.1f} seconds"
+            ),
+            key_len=self.key_len,
+        )(func)
+
     def translate(self, text, needprint=True):
         start_time = time.time()
         # todo: Determine whether to print according to the cli option
         if needprint:
-            print(re.sub("\n{3,}", "\n\n", text))
-
-        attempt_count = 0
-        max_attempts = 3
-        t_text = ""
-
-        while attempt_count < max_attempts:
-            try:
-                t_text = self.get_translation(text)
-                break
-            except RateLimitError as e:
-                # todo: better sleep time? why sleep alawys about key_len
-                # 1. openai server error or own network interruption, sleep for a fixed time
-                # 2. an apikey has no money or reach limit, don`t sleep, just replace it with another apikey
-                # 3. all apikey reach limit, then use current sleep
-                sleep_time = int(60 / self.key_len)
-                print(e, f"will sleep {sleep_time} seconds")
-                time.sleep(sleep_time)
-                attempt_count += 1
-                if attempt_count == max_attempts:
-                    print(f"Get {attempt_count} consecutive exceptions")
-                    raise
-            except Exception as e:
-                print(str(e))
-                return
+            print(_RE_COLLAPSE_NL.sub("\n\n", text))
+
+        try:
+            t_text = self.retry_on_api_error(self.get_translation)(text)
+        except Exception as e:
+            if is_retryable_error(e):
+                print(f"Get {RETRY_MAX_TRIES} consecutive exceptions")
+                raise
+            print(str(e))
+            return
 
         # todo: Determine whether to print according to the cli option
         if needprint:
-            print("[bold green]" + re.sub("\n{3,}", "\n\n", t_text) + "[/bold green]")
+            print(
+                "[bold green]" + _RE_COLLAPSE_NL.sub("\n\n", t_text) + "[/bold green]"
+            )
 
         time.time() - start_time
         # print(f"translation time: {elapsed_time:.1f}s")
@@ -239,11 +519,9 @@ class ChatGPTAPI(Base):
         if retry_count == 0:
             return
         print(f"retry {state}")
-        with open(log_path, "a", encoding="utf-8") as f:
-            print(
-                f"retry {state}, count = {retry_count}, time = {elapsed_time:.1f}s",
-                file=f,
-            )
+        get_file_logger(log_path).info(
+            f"retry {state}, count = {retry_count}, time = {elapsed_time:.1f}s"
+        )
 
     def log_translation_mismatch(
         self,
@@ -256,16 +534,17 @@ class ChatGPTAPI(Base):
         if len(result_list) == plist_len:
             return
         newlist = new_str.split(sep)
-        with open(log_path, "a", encoding="utf-8") as f:
-            print(f"problem size: {plist_len - len(result_list)}", file=f)
-            for i in range(len(newlist)):
-                print(newlist[i], file=f)
-                print(file=f)
-                if i < len(result_list):
-                    print("............................................", file=f)
-                    print(result_list[i], file=f)
-                    print(file=f)
-                print("=============================", file=f)
+        lines = [f"problem size: {plist_len - len(result_list)}"]
+        for i in range(len(newlist)):
+            lines += [newlist[i], ""]
+            if i < len(result_list):
+                lines += [
+                    "............................................",
+                    result_list[i],
+                    "",
+                ]
+            lines.append("=============================")
+        get_file_logger(log_path).info("\n".join(lines))
 
         print(
             f"bug: {plist_len} paragraphs of text translated into {len(result_list)} paragraphs",
@@ -273,48 +552,314 @@ class ChatGPTAPI(Base):
         print("continue")
 
     def join_lines(self, text):
-        lines = text.splitlines()
-        new_lines = []
-        temp_line = []
-
-        # join
-        for line in lines:
-            if line.strip():
-                temp_line.append(line.strip())
-            else:
+        def joined_lines():
+            temp_line = []
+            for line in text.splitlines():
+                stripped = line.strip()
+                if stripped:
+                    temp_line.append(stripped)
+                    continue
                 if temp_line:
-                    new_lines.append(" ".join(temp_line))
+                    yield " ".join(temp_line)
                     temp_line = []
-                new_lines.append(line)
+                yield line
+            if temp_line:
+                yield " ".join(temp_line)
 
-        if temp_line:
-            new_lines.append(" ".join(temp_line))
-
-        text = "\n".join(new_lines)
+        new_text = "\n".join(joined_lines())
         # try to fix #372
-        if not text:
+        if not new_text:
             return ""
 
-        # del ^M
-        text = text.replace("^M", "\r")
-        lines = text.splitlines()
-        filtered_lines = [line for line in lines if line.strip() != "\r"]
-        new_text = "\n".join(filtered_lines)
-
+        # del ^M, a literal caret-M is rare so only split again when present
+        if "^M" in new_text:
+            return "\n".join(new_text.replace("^M", "\r").splitlines())
+        # a trailing blank line was always dropped by the split above
+        if new_text.endswith("\n"):
+            new_text = new_text[:-1]
         return new_text
 
     def translate_list(self, plist):
+        if not self.async_api:
+            return self.translate_list_structured(plist)
+
+        plist_len = len(plist)
+        print(f"plist len = {plist_len}")
+
+        texts = [paragraph_text(p) for p in plist]
+        translated_paragraphs = [""] * plist_len
+
+        context_messages = self.create_context_messages()
+        use_cache = self.translation_cache is not None and not context_messages
+        requests = []
+        cache_keys = {}
+        for batch in self._batch_paragraphs(texts):
+            # rotate key and model per request before waiting for a free slot
+            api_key, model = self.next_key_and_model()
+            if use_cache:
+                # sqlite stays on this thread, the event loop only sees the misses
+                misses = []
+                for index, text in batch:
+                    key = self.translation_cache_key(text, model)
+                    t_text = self.translation_cache.get(key)
+                    if t_text is None:
+                        cache_keys[index] = key
+                        misses.append((index, text))
+                    else:
+                        translated_paragraphs[index] = t_text
+                if not misses:
+                    continue
+                batch = misses
+            requests.append((batch, context_messages, api_key, model))
+
+        batch_results = run_async(
+            process_concurrently_async(
+                requests, self._async_translate_batch, max_concurrent=self.key_len * 8
+            )
+        )
+
+        for (batch, *_), result_list in zip(requests, batch_results):
+            for (index, _), t_text in zip(batch, result_list):
+                translated_paragraphs[index] = t_text
+                if t_text and index in cache_keys:
+                    self.translation_cache.set(cache_keys[index], t_text)
+
+        if self.context_flag:
+            for text, t_text in zip(texts, translated_paragraphs):
+                self.save_context(text, t_text)
+
+        return translated_paragraphs
+
+    @cached_property
+    def batch_prompt_tokens(self):
+        # the fixed part of BATCH_PROMPT, counted once instead of per request
+        return count_tokens(
+            self.BATCH_PROMPT.format(text="", count=0, language=self.language)
+        )
+
+    def _batch_paragraphs(self, texts, max_tokens=3000):
+        """Greedily pack (index, text) pairs into batches of at most max_tokens."""
+        items = [(index, text) for index, text in enumerate(texts) if text]
+        max_tokens -= self.batch_prompt_tokens
+        # the loader only hands over lists of at most accumulated_num tokens,
+        # and a token is at least one utf-8 byte (which only helps for short
+        # lists), skip tokenizing when either bound already fits the budget
+        if 0 < self.accumulated_num <= max_tokens or (
+            sum(len(text.encode("utf-8")) for _, text in items) <= max_tokens
+        ):
+            if items:
+                yield items
+            return
+
+        batch = []
+        batch_tokens = 0
+        token_counts = count_tokens_batch([text for _, text in items])
+        for (index, text), tokens in zip(items, token_counts):
+            if batch and batch_tokens + tokens > max_tokens:
+                yield batch
+                batch = []
+                batch_tokens = 0
+            batch.append((index, text))
+            batch_tokens += tokens
+        if batch:
+            yield batch
+
+    def create_batch_messages(self, text, count, intermediate_messages=None):
+        content = self.BATCH_PROMPT.format(
+            text=text, count=count, language=self.language
+        )
+
+        sys_content = self.system_content or self.prompt_sys_msg.format(crlf="\n")
+        messages = [
+            {"role": "system", "content": sys_content},
+        ]
+
+        if intermediate_messages:
+            messages.extend(intermediate_messages)
+
+        messages.append({"role": "user", "content": content})
+        return messages
+
+    def parse_batch_translation(self, text, count):
+        result_list = load_json_array(text)
+        if isinstance(result_list, list) and all(
+            isinstance(item, str) for item in result_list
+        ):
+            return [_RE_NUM_PREFIX.sub("", item).strip() for item in result_list]
+
+        # not a json array of strings, fall back to the (n) markers
+        return self.extract_paragraphs(text, count)
+
+    async def _async_translate_batch(self, request):
+        batch, context_messages, api_key, model = request
+        if len(batch) == 1:
+            text = batch[0][1]
+            messages = self.create_messages(text, context_messages)
+            return [await self._async_translate((text, messages, api_key, model))]
+
+        sep = "\n\n"
+        new_str = sep.join(f"({i}) {text}" for i, (_, text) in enumerate(batch, 1))
+        messages = self.create_batch_messages(new_str, len(batch), context_messages)
+        t_text = await self._async_translate(
+            (new_str, messages, api_key, model), json_array=True
+        )
+        result_list = self.parse_batch_translation(t_text, len(batch))
+        if len(result_list) == len(batch):
+            return result_list
+
+        self.log_translation_mismatch(len(batch), result_list, new_str, sep)
+        texts = [text for _, text in batch]
+        dropped = find_dropped_paragraph(texts, t_text, result_list)
+        if dropped is not None:
+            # only one paragraph went missing, translate just that one
+            print(f"retranslate dropped paragraph {dropped + 1}")
+            text = texts[dropped]
+            api_key, model = self.next_key_and_model()
+            result_list.insert(
+                dropped,
+                await self._async_translate(
+                    (text, self.create_messages(text, context_messages), api_key, model)
+                ),
+            )
+            return result_list
+
+        # the model merged or dropped items, translate the batch one by one
+        requests = []
+        for _, text in batch:
+            api_key, model = self.next_key_and_model()
+            requests.append(
+                (text, self.create_messages(text, context_messages), api_key, model)
+            )
+        return await process_concurrently_async(
+            requests, self._async_translate, max_concurrent=self.key_len
+        )
+
+    def next_key_and_model(self):
+        with self._api_lock:
+            api_key = next(self.keys)
+            model = next(self.model_list) if self.model_list else self.model
+        return api_key, model
+
+    def get_async_azure_client(self, api_key):
+        # only called from the background event loop, so no lock needed
+        cache_key = (api_key, self.api_base, self.deployment_id)
+        client = _ASYNC_AZURE_CLIENTS.get(cache_key)
+        if client is None:
+            client = AsyncAzureOpenAI(
+                api_key=api_key,
+                azure_endpoint=self.api_base,
+                api_version="2023-07-01-preview",
+                azure_deployment=self.deployment_id,
+                http_client=get_async_http_client(self.api_base),
+            )
+            _ASYNC_AZURE_CLIENTS[cache_key] = client
+        return client
+
+    async def _acquire_rate_limit(self, messages):
+        # whole prompts are rarely seen twice, keep them out of the count_tokens lru
+        encoding = _get_encoding("cl100k_base")
+        prompt_tokens = (
+            sum(len(encoding.encode(message["content"])) for message in messages)
+            if self.rate_limiter.tpm
+            else 0
+        )
+        await self.rate_limiter.acquire(token_cost=prompt_tokens)
+
+    async def _async_get_translation(self, messages, api_key, model, json_array=False):
+        if self.rate_limiter:
+            await self._acquire_rate_limit(messages)
+        if json_array:
+            return await self._async_get_json_array(messages, api_key, model)
+        if self.deployment_id:
+            # azure needs its own url scheme and auth header, keep the sdk client
+            completion = await self.get_async_azure_client(
+                api_key
+            ).chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=self.temperature,
+            )
+            return completion.choices[0].message.content or ""
+
+        completion = await chat_completion(
+            messages, model, self.temperature, api_key, self.api_base
+        )
+        return completion["choices"][0]["message"]["content"] or ""
+
+    async def _async_get_json_array(self, messages, api_key, model):
+        # stop reading once the array is closed, whatever the model adds after
+        # it (a closing fence, "Hope this helps!") is never generated
+        parts = []
+        array_end = JSONArrayEnd()
+        async with aclosing(
+            self._async_stream_translation(messages, api_key, model)
+        ) as stream:
+            async for content in stream:
+                end = array_end.feed(content)
+                if end != -1:
+                    parts.append(content[:end])
+                    break
+                parts.append(content)
+        return "".join(parts)
+
+    async def _async_stream_translation(self, messages, api_key, model):
+        if self.deployment_id:
+            stream = await self.get_async_azure_client(api_key).chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=self.temperature,
+                stream=True,
+            )
+            async with stream:
+                async for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+            return
+
+        async with aclosing(
+            stream_chat_completion(
+                messages, model, self.temperature, api_key, self.api_base
+            )
+        ) as stream:
+            async for content in stream:
+                yield content
+
+    async def _async_translate(self, request, json_array=False):
+        text, messages, api_key, model = request
+        if not text:
+            return ""
+
+        api_keys = [api_key]
+
+        async def get_translation():
+            try:
+                return await self._async_get_translation(
+                    messages, api_keys[-1], model, json_array=json_array
+                )
+            except Exception:
+                # every retry goes out with the next key
+                api_keys.append(self.next_key_and_model()[0])
+                raise
+
+        try:
+            return await self.retry_on_api_error(get_translation)()
+        except Exception as e:
+            # unlike translate() there is no None for the loader to check, so
+            # fail loudly instead of writing the book with blank translations
+            if is_retryable_error(e):
+                print(f"Get {RETRY_MAX_TRIES} consecutive exceptions")
+            else:
+                print(str(e))
+            raise
+
+    def translate_list_structured(self, plist):
         plist_len = len(plist)
 
         # Create a list of original texts and add clear numbering markers to each paragraph
-        formatted_text = ""
-        for i, p in enumerate(plist, 1):
-            temp_p = copy(p)
-            for sup in temp_p.find_all("sup"):
-                sup.extract()
-            para_text = temp_p.get_text().strip()
-            # Using special delimiters and clear numbering
-            formatted_text += f"PARAGRAPH {i}:\n{para_text}\n\n"
+        # Using special delimiters and clear numbering
+        formatted_text = "".join(
+            f"PARAGRAPH {i}:\n{paragraph_text(p)}\n\n" for i, p in enumerate(plist, 1)
+        )
 
         print(f"plist len = {plist_len}")
 
@@ -337,18 +882,15 @@ class ChatGPTAPI(Base):
 
         translated_text = self.translate(formatted_text, False)
 
-        # Extract translations from structured output
+        # Extract translations from structured output, in one pass over the text
+        structured_matches = {}
+        for num_str, content in _RE_STRUCTURED_PARAGRAPH.findall(translated_text):
+            structured_matches.setdefault(int(num_str), content)
+
         translated_paragraphs = []
         for i in range(1, plist_len + 1):
-            pattern = (
-                r"TRANSLATION OF PARAGRAPH "
-                + str(i)
-                + r":(.*?)(?=TRANSLATION OF PARAGRAPH \d+:|\Z)"
-            )
-            matches = re.findall(pattern, translated_text, re.DOTALL)
-
-            if matches:
-                translated_paragraph = matches[0].strip()
+            if i in structured_matches:
+                translated_paragraph = structured_matches[i].strip()
                 translated_paragraphs.append(translated_paragraph)
             else:
                 print(f"Warning: Could not find translation for paragraph {i}")
@@ -371,8 +913,7 @@ class ChatGPTAPI(Base):
                 f"Warning: Extracted {len(translated_paragraphs)}/{plist_len} paragraphs. Using fallback extraction."
             )
 
-            all_para_pattern = r"(?:TRANSLATION|PARAGRAPH|PARA).*?(\d+).*?:(.*?)(?=(?:TRANSLATION|PARAGRAPH|PARA).*?\d+.*?:|\Z)"
-            all_matches = re.findall(all_para_pattern, translated_text, re.DOTALL)
+            all_matches = _RE_LOOSE_PARAGRAPH.findall(translated_text)
 
             if all_matches:
                 # Create a dictionary to map translation content based on paragraph numbers
@@ -417,8 +958,7 @@ class ChatGPTAPI(Base):
 
         # If exact pattern matching failed, try another approach
         if len(result_list) != paragraph_count:
-            pattern = r"\((\d+)\)\s*(.*?)(?=\s*\(\d+\)|\Z)"
-            matches = re.findall(pattern, text, re.DOTALL)
+            matches = _RE_NUMBERED_PARAGRAPH.findall(text)
             if matches:
                 # Sort by paragraph number
                 matches.sort(key=lambda x: int(x[0]))
@@ -438,6 +978,7 @@ class ChatGPTAPI(Base):
             azure_endpoint=self.api_base,
             api_version="2023-07-01-preview",
             azure_deployment=self.deployment_id,
+            http_client=get_http_client(self.api_base),
         )
 
     def set_gpt35_models(self, ollama_model=""):
@@ -455,6 +996,17 @@ class ChatGPTAPI(Base):
             print(f"Using model list {model_list}")
             self.model_list = cycle(model_list)
 
+    def set_rate_limit(self, rpm=0, tpm=0):
+        if rpm or tpm:
+            print(
+                f"Limiting requests to {rpm or 'unlimited'} rpm, {tpm or 'unlimited'} tpm"
+            )
+            self.rate_limiter = AsyncTokenBucket(rpm, tpm)
+
+    def set_translation_cache(self, path=DEFAULT_CACHE_PATH):
+        self.translation_cache = TranslationCache(path)
+        print(f"Using translation cache {path}")
+
     def set_gpt4_models(self):
         # for issue #375 azure can not use model list
         if self.deployment_id:
@@ -576,12 +1128,17 @@ class ChatGPTAPI(Base):
         with open(batch_metadata_file_path, "r", encoding="utf-8") as f:
             batch_info = json.load(f)
 
+        completed = True
         for batch_file in batch_info["batch_files"]:
             batch_status = self.check_batch_status(batch_file["batch_id"])
+            if batch_status.status in ("failed", "expired", "cancelled"):
+                raise Exception(
+                    f"Batch {batch_file['batch_id']} is {batch_status.status}"
+                )
             if batch_status.status != "completed":
-                return False
+                completed = False
 
-        return True
+        return completed
 
     def batch_translate(self, book_index):
         if self.batch_info_cache is None:
@@ -599,26 +1156,26 @@ class ChatGPTAPI(Base):
         if not target_batch:
             raise ValueError(f"No batch found for book_index {book_index}")
 
-        if target_batch["batch_id"] in self.result_content_cache:
-            result_content = self.result_content_cache[target_batch["batch_id"]]
-        else:
+        if target_batch["batch_id"] not in self.result_content_cache:
             batch_status = self.check_batch_status(target_batch["batch_id"])
             if batch_status.output_file_id is None:
                 raise ValueError(f"Batch {target_batch['batch_id']} is not completed")
             result_content = self.get_batch_result(batch_status.output_file_id)
-            self.result_content_cache[target_batch["batch_id"]] = result_content
+            # index the output once instead of scanning it for every paragraph
+            results = {}
+            for line in result_content.text.split("\n"):
+                if line.strip():
+                    result = json.loads(line)
+                    results[result["custom_id"]] = result["response"]["body"][
+                        "choices"
+                    ][0]["message"]["content"]
+            self.result_content_cache[target_batch["batch_id"]] = results
 
-        result_lines = result_content.text.split("\n")
         custom_id = self.custom_id(book_index)
-        for line in result_lines:
-            if line.strip():
-                result = json.loads(line)
-                if result["custom_id"] == custom_id:
-                    return result["response"]["body"]["choices"][0]["message"][
-                        "content"
-                    ]
-
-        raise ValueError(f"No result found for custom_id {custom_id}")
+        results = self.result_content_cache[target_batch["batch_id"]]
+        if custom_id not in results:
+            raise ValueError(f"No result found for custom_id {custom_id}")
+        return results[custom_id]
 
     def create_batch_context_messages(self, index):
         messages = []
@@ -739,9 +1296,8 @@ class ChatGPTAPI(Base):
         }
 
     def upload_batch_file(self, file_path):
-        batch_input_file = self.openai_client.files.create(
-            file=open(file_path, "rb"), purpose="batch"
-        )
+        with open(file_path, "rb") as f:
+            batch_input_file = self.openai_client.files.create(file=f, purpose="batch")
         return batch_input_file.id
 
     def batch_execute(self, file_id):
@@ -13,6 +13,8 @@ GROQ_MODEL_LIST = [
 
 
 class GroqClient(ChatGPTAPI):
+    async_api = False
+
     def rotate_model(self):
         if not self.model_list:
             model_list = list(set(GROQ_MODEL_LIST))
@@ -11,6 +11,8 @@ PROMPT_ENV_MAP = {
 
 
 class liteLLM(ChatGPTAPI):
+    async_api = False
+
     def create_chat_completion(self, text):
         # content = self.prompt_template.format(
         #     text=text, language=self.language, crlf="\n"
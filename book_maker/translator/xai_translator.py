@@ -1,4 +1,5 @@
 from openai import OpenAI
+from ._http import get_http_client
 from .chatgptapi_translator import ChatGPTAPI
 
 
@@ -8,11 +9,17 @@ XAI_MODEL_LIST = [
 
 
 class XAIClient(ChatGPTAPI):
+    async_api = False
+
     def __init__(self, key, language, api_base=None, **kwargs) -> None:
         super().__init__(key, language)
         self.model_list = XAI_MODEL_LIST
         self.api_url = str(api_base) if api_base else "https://api.x.ai/v1"
-        self.openai_client = OpenAI(api_key=key, base_url=self.api_url)
+        self.openai_client = OpenAI(
+            api_key=key,
+            base_url=self.api_url,
+            http_client=get_http_client(self.api_url),
+        )
 
     def rotate_model(self):
         self.model = self.model_list[0]
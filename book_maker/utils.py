@@ -1,3 +1,12 @@
+import asyncio
+import atexit
+import logging
+import os
+import queue
+import threading
+from functools import lru_cache
+from logging.handlers import QueueHandler, QueueListener
+
 import tiktoken
 
 # Borrowed from : https://github.com/openai/whisper
@@ -131,6 +140,103 @@ def prompt_config_to_kwargs(prompt_config):
     )
 
 
+@lru_cache(maxsize=8)
+def _get_encoding(encoding_name):
+    return tiktoken.get_encoding(encoding_name)
+
+
+@lru_cache(maxsize=8)
+def _get_encoding_for_model(model):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return _get_encoding("cl100k_base")
+
+
+@lru_cache(maxsize=4096)
+def count_tokens(text, encoding_name="cl100k_base"):
+    """Returns the number of tokens of text, memoized on (text, encoding_name)."""
+    return len(_get_encoding(encoding_name).encode(text))
+
+
+def count_tokens_batch(texts, encoding_name="cl100k_base", num_threads=8):
+    """Returns the number of tokens of each text, tokenized in parallel threads."""
+    encoded = _get_encoding(encoding_name).encode_ordinary_batch(
+        texts, num_threads=num_threads
+    )
+    return [len(tokens) for tokens in encoded]
+
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def _get_background_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=_loop.run_forever, name="bbm-event-loop", daemon=True
+            ).start()
+    return _loop
+
+
+def run_async(coro):
+    """Run coro on the shared background event loop and block until it is done.
+
+    Unlike asyncio.run this can be called from any thread (including the
+    parallel chapter workers), and async clients created inside the coroutine
+    stay bound to one long-lived loop, so their connection pools can be reused.
+    """
+    return asyncio.run_coroutine_threadsafe(coro, _get_background_loop()).result()
+
+
+async def process_concurrently_async(items, func, max_concurrent=10):
+    """Await func(item) for every item, at most max_concurrent at a time.
+
+    Results are returned in the same order as items.
+    """
+    semaphore = asyncio.Semaphore(max_concurrent)
+
+    async def limited_func(item):
+        async with semaphore:
+            return await func(item)
+
+    return await asyncio.gather(*(limited_func(item) for item in items))
+
+
+_file_loggers = {}
+_file_loggers_lock = threading.Lock()
+
+
+def get_file_logger(path):
+    """Return a logger that appends plain messages to the file at path.
+
+    The file is opened once and written by a listener thread, callers (the
+    event loop included) only put the record on a queue.
+    """
+    path = os.path.abspath(path)
+    with _file_loggers_lock:
+        logger = _file_loggers.get(path)
+        if logger is None:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            handler = logging.FileHandler(path, encoding="utf-8")
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            records = queue.SimpleQueue()
+            listener = QueueListener(records, handler)
+            listener.start()
+            # flushes whatever is still queued before the interpreter exits
+            atexit.register(listener.stop)
+
+            logger = logging.getLogger(f"{__name__}.file.{path}")
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+            logger.addHandler(QueueHandler(records))
+            _file_loggers[path] = logger
+    return logger
+
+
 # ref: https://platform.openai.com/docs/guides/chat/introduction
 def num_tokens_from_text(text, model="gpt-3.5-turbo-0301"):
     messages = (
@@ -141,10 +247,7 @@ def num_tokens_from_text(text, model="gpt-3.5-turbo-0301"):
     )
 
     """Returns the number of tokens used by a list of messages."""
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        encoding = tiktoken.get_encoding("cl100k_base")
+    encoding = _get_encoding_for_model(model)
     if model == "gpt-3.5-turbo-0301":  # note: future models may deviate from this
         num_tokens = 0
         for message in messages:
@@ -152,7 +255,7 @@ def num_tokens_from_text(text, model="gpt-3.5-turbo-0301"):
                 4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
             )
             for key, value in message.items():
-                num_tokens += len(encoding.encode(value))
+                num_tokens += count_tokens(value, encoding.name)
                 if key == "name":  # if there's a name, the role is omitted
                     num_tokens += -1  # role is always required and always 1 token
         num_tokens += 2  # every reply is primed with <im_start>assistant
@@ -0,0 +1,486 @@
+import asyncio
+import json
+import threading
+from itertools import cycle
+from types import SimpleNamespace
+
+import pytest
+from aiohttp import ClientResponseError, RequestInfo
+from bs4 import BeautifulSoup
+from multidict import CIMultiDict
+from yarl import URL
+
+from book_maker.translator import _http, chatgptapi_translator
+from book_maker.translator._ratelimit import AsyncTokenBucket
+from book_maker.translator.chatgptapi_translator import (
+    ChatGPTAPI,
+    JSONArrayEnd,
+    find_dropped_paragraph,
+    paragraph_text,
+    wait_for_retry,
+)
+from book_maker.utils import run_async
+
+
+@pytest.fixture(autouse=True)
+def word_count_tokens(monkeypatch):
+    # tiktoken downloads its encodings on first use, keep these tests offline
+    monkeypatch.setattr(
+        chatgptapi_translator, "count_tokens", lambda text: len(text.split())
+    )
+    monkeypatch.setattr(
+        chatgptapi_translator,
+        "count_tokens_batch",
+        lambda texts: [len(text.split()) for text in texts],
+    )
+
+
+def make_translator(key="key1,key2"):
+    translator = ChatGPTAPI(key, "simplified chinese")
+    translator.model_list = cycle(["gpt-4o-mini"])
+    return translator
+
+
+def make_plist(texts):
+    html = "".join(f"<p>{text}</p>" for text in texts)
+    return BeautifulSoup(html, "html.parser").find_all("p")
+
+
+def test_batch_paragraphs_respects_token_budget():
+    translator = make_translator()
+    translator.batch_prompt_tokens = 0
+    texts = ["a b c", "", "d e", "f g h i", "j"]
+
+    batches = list(translator._batch_paragraphs(texts, max_tokens=5))
+
+    assert batches == [
+        [(0, "a b c"), (2, "d e")],
+        [(3, "f g h i"), (4, "j")],
+    ]
+
+
+def test_batch_paragraphs_skips_tokenizing_when_bytes_fit(monkeypatch):
+    translator = make_translator()
+    translator.batch_prompt_tokens = 10
+
+    def fail(text):
+        raise AssertionError("should not tokenize")
+
+    monkeypatch.setattr(chatgptapi_translator, "count_tokens", fail)
+    monkeypatch.setattr(chatgptapi_translator, "count_tokens_batch", fail)
+
+    assert list(translator._batch_paragraphs(["一", "", "two"], max_tokens=20)) == [
+        [(0, "一"), (2, "two")]
+    ]
+
+
+def test_batch_paragraphs_trusts_the_accumulated_num_bound(monkeypatch):
+    translator = make_translator()
+    translator.batch_prompt_tokens = 100
+    translator.accumulated_num = 1600
+
+    def fail(texts):
+        raise AssertionError("should not tokenize")
+
+    monkeypatch.setattr(chatgptapi_translator, "count_tokens_batch", fail)
+    texts = ["long paragraph " * 200, "一二三" * 300]
+
+    assert list(translator._batch_paragraphs(texts)) == [list(enumerate(texts))]
+
+
+def test_translate_list_sends_one_request_per_batch():
+    translator = make_translator()
+    requests = []
+
+    async def fake_get_translation(messages, api_key, model, json_array=False):
+        requests.append(messages[-1]["content"])
+        return json.dumps(["(1) 一", "(2) 二", "(3) 三"])
+
+    translator._async_get_translation = fake_get_translation
+
+    plist = make_plist(["one<sup>1</sup>", "two", "three"])
+    assert translator.translate_list(plist) == ["一", "二", "三"]
+    assert len(requests) == 1
+    assert "(1) one\n\n(2) two\n\n(3) three" in requests[0]
+    # the footnote marker is only dropped from the text sent for translation
+    assert plist[0].find("sup") is not None
+
+
+def test_translate_list_falls_back_to_single_paragraphs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    translator = make_translator()
+
+    async def fake_get_translation(messages, api_key, model, json_array=False):
+        content = messages[-1]["content"]
+        if "JSON array" in content:
+            return json.dumps(["(1) 一二"])
+        return content.split("`")[1].upper()
+
+    translator._async_get_translation = fake_get_translation
+
+    plist = make_plist(["one", "two"])
+    assert translator.translate_list(plist) == ["ONE", "TWO"]
+    assert (tmp_path / "log" / "buglog.txt").exists()
+
+
+def test_batch_translate_indexes_batch_output_once():
+    translator = make_translator()
+    translator.batch_init("my book")
+    translator.batch_info_cache = {
+        "batch_files": [{"batch_id": "b1", "start_index": 0, "end_index": 3}]
+    }
+    lines = [
+        {
+            "custom_id": translator.custom_id(i),
+            "response": {"body": {"choices": [{"message": {"content": f"t{i}"}}]}},
+        }
+        for i in range(3)
+    ]
+    downloads = []
+
+    def fake_get_batch_result(output_file_id):
+        downloads.append(output_file_id)
+        return SimpleNamespace(text="\n".join(json.dumps(line) for line in lines))
+
+    translator.check_batch_status = lambda batch_id: SimpleNamespace(
+        output_file_id="out1"
+    )
+    translator.get_batch_result = fake_get_batch_result
+
+    assert [translator.batch_translate(i) for i in (2, 0, 1)] == ["t2", "t0", "t1"]
+    assert downloads == ["out1"]
+
+
+def make_response_error(status, headers=None):
+    url = URL("https://api.openai.com/v1/chat/completions")
+    return ClientResponseError(
+        RequestInfo(url, "POST", CIMultiDict(), url),
+        (),
+        status=status,
+        message="error",
+        headers=CIMultiDict(headers or {}),
+    )
+
+
+def test_retry_honors_retry_after_and_rotates_keys():
+    translator = make_translator()
+    used_keys = []
+
+    async def fake_get_translation(messages, api_key, model, json_array=False):
+        used_keys.append(api_key)
+        if len(used_keys) == 1:
+            raise make_response_error(429, {"Retry-After": "0"})
+        return "ok"
+
+    translator._async_get_translation = fake_get_translation
+
+    assert translator.translate_list(make_plist(["one"])) == ["ok"]
+    assert used_keys[0] != used_keys[1]
+
+
+def test_translate_list_raises_non_retryable_errors():
+    translator = make_translator()
+    requests = []
+
+    async def fake_get_translation(messages, api_key, model, json_array=False):
+        requests.append(model)
+        raise make_response_error(404)
+
+    translator._async_get_translation = fake_get_translation
+
+    with pytest.raises(ClientResponseError):
+        translator.translate_list(make_plist(["one", "two", "three"]))
+    assert len(requests) == 1
+
+
+def test_wait_for_retry_gives_up_once_every_key_failed_auth():
+    wait = wait_for_retry(key_len=2)
+    next(wait)
+
+    assert wait.send(make_response_error(401)) == 0
+    with pytest.raises(StopIteration):
+        wait.send(make_response_error(401))
+
+
+@pytest.mark.parametrize(
+    "reply",
+    [
+        '["(1) 一", "(2) 二"]',
+        '```json\n["(1) 一", "(2) 二"]\n```',
+        'Here you go:\n["一", "二"]\nHope this helps!',
+    ],
+)
+def test_parse_batch_translation_tolerates_wrapped_json(reply):
+    assert make_translator().parse_batch_translation(reply, 2) == ["一", "二"]
+
+
+def test_parse_batch_translation_falls_back_to_markers():
+    reply = '(1) 一\n(2) 二, "broken json'
+    assert make_translator().parse_batch_translation(reply, 2) == [
+        "一",
+        '二, "broken json',
+    ]
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("", ""),
+        ("one\n  two \n\nthree\n", "one two\n\nthree"),
+        ("one\n\n\n", "one\n"),
+        ("one^Mtwo", "one\ntwo"),
+    ],
+)
+def test_join_lines(text, expected):
+    assert make_translator().join_lines(text) == expected
+
+
+def test_paragraph_text_skips_footnote_markers_in_place():
+    (p,) = make_plist([" one<sup><a>1</a></sup> <em>two<sup>2</sup></em> "])
+
+    assert paragraph_text(p) == "one two"
+    assert len(p.find_all("sup")) == 2
+
+
+def test_token_bucket_waits_for_refill():
+    now = [0.0]
+    sleeps = []
+
+    async def fake_sleep(seconds):
+        sleeps.append(seconds)
+        now[0] += seconds
+
+    bucket = AsyncTokenBucket(rpm=60, tpm=600, clock=lambda: now[0], sleep=fake_sleep)
+
+    async def acquire_all():
+        await bucket.acquire(token_cost=500)
+        await bucket.acquire(token_cost=200)
+        await bucket.acquire(token_cost=10_000)
+
+    asyncio.run(acquire_all())
+    # 100 missing tokens at 10/s, then a request larger than the bucket only
+    # waits for the bucket to be full again
+    assert sleeps == [pytest.approx(10), pytest.approx(60)]
+
+
+def test_translate_waits_on_the_rate_limiter(monkeypatch):
+    translator = make_translator()
+    acquired = []
+
+    def fail(text):
+        raise AssertionError("prompts should not go through the count_tokens lru")
+
+    monkeypatch.setattr(chatgptapi_translator, "count_tokens", fail)
+    monkeypatch.setattr(
+        chatgptapi_translator,
+        "_get_encoding",
+        lambda name: SimpleNamespace(encode=str.split),
+    )
+
+    class FakeBucket:
+        tpm = 1000
+
+        async def acquire(self, request_cost=1, token_cost=0):
+            acquired.append(token_cost)
+
+    translator.rate_limiter = FakeBucket()
+    translator.create_chat_completion = lambda text: SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(content="一二"))]
+    )
+
+    assert translator.translate("one two", needprint=False) == "一二"
+    assert len(acquired) == 1 and acquired[0] > 0
+
+
+def test_translate_list_reuses_cached_paragraphs(tmp_path):
+    translator = make_translator()
+    translator.set_translation_cache(str(tmp_path / "translations.db"))
+    requests = []
+
+    async def fake_get_translation(messages, api_key, model, json_array=False):
+        requests.append(messages[-1]["content"])
+        return json.dumps(["(1) 一", "(2) 二"])
+
+    translator._async_get_translation = fake_get_translation
+    assert translator.translate_list(make_plist(["one", "two"])) == ["一", "二"]
+
+    async def fake_get_single_translation(messages, api_key, model, json_array=False):
+        requests.append(messages[-1]["content"])
+        return "三"
+
+    translator = make_translator()
+    translator.set_translation_cache(str(tmp_path / "translations.db"))
+    translator._async_get_translation = fake_get_single_translation
+    cache_threads = set()
+    cache = translator.translation_cache
+    for name in ("get", "set"):
+        method = getattr(cache, name)
+
+        def record(*args, method=method):
+            cache_threads.add(threading.current_thread())
+            return method(*args)
+
+        setattr(cache, name, record)
+
+    plist = make_plist(["two", "three", "one"])
+    assert translator.translate_list(plist) == ["二", "三", "一"]
+    assert len(requests) == 2
+    assert "`three`" in requests[1]
+    # sqlite is only touched from the caller, never from the event loop thread
+    assert cache_threads == {threading.current_thread()}
+
+
+@pytest.mark.parametrize(
+    "chunks, expected",
+    [
+        (['```json\n["(1) a]", "(2', ') b\\""]\n```', "never sent"], 7),
+        (["[[1], ", "[2]]", " done"], 4),
+        (["Here you go:\n", '["a"]'], -1),
+    ],
+)
+def test_json_array_end(chunks, expected):
+    array_end = JSONArrayEnd()
+    ends = [array_end.feed(chunk) for chunk in chunks]
+    assert max(ends) == expected
+
+
+def test_batch_reply_stream_stops_after_the_array():
+    translator = make_translator()
+    closed = []
+
+    async def fake_stream_translation(messages, api_key, model):
+        try:
+            for content in ['["(1) 一", ', '"(2) 二"]', "\nHope this helps!"]:
+                yield content
+        finally:
+            closed.append(True)
+
+    translator._async_stream_translation = fake_stream_translation
+
+    reply = asyncio.run(
+        translator._async_get_translation([], "key", "model", json_array=True)
+    )
+    assert reply == '["(1) 一", "(2) 二"]'
+    assert closed == [True]
+
+
+@pytest.mark.parametrize(
+    "texts, reply, result_list, expected",
+    [
+        # the item numbers show the gap
+        ("abcd", '["(1) 一", "(2) 二", "(4) 四"]', ["一", "二", "四"], 2),
+        # renumbered reply, only the digits inside the paragraphs tell
+        (
+            ["a", "b 2", "c", "d 4"],
+            '["(1) 一", "(2) 二2", "(3) 四4"]',
+            ["一", "二2", "四4"],
+            2,
+        ),
+        # no way to tell which of the undigited paragraphs is gone
+        ("abcd", '["(1) 一", "(2) 二", "(3) 四"]', ["一", "二", "四"], None),
+        # the item before the gap is twice as long, a merge rather than a drop
+        ("abcd", '["(1) 一", "(2) 二三", "(4) 四"]', ["一", "二三", "四"], None),
+    ],
+)
+def test_find_dropped_paragraph(texts, reply, result_list, expected):
+    assert find_dropped_paragraph(list(texts), reply, result_list) == expected
+
+
+def test_translate_list_retranslates_only_the_dropped_paragraph(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    translator = make_translator()
+    requests = []
+
+    async def fake_get_translation(messages, api_key, model, json_array=False):
+        requests.append(messages[-1]["content"])
+        if json_array:
+            return json.dumps(["(1) 一", "(3) 三"])
+        return "二"
+
+    translator._async_get_translation = fake_get_translation
+
+    assert translator.translate_list(make_plist(["one", "two", "three"])) == [
+        "一",
+        "二",
+        "三",
+    ]
+    assert len(requests) == 2
+    assert "`two`" in requests[1]
+
+
+def test_chat_completion_goes_through_the_proxy_env(monkeypatch):
+    request_lines = []
+
+    async def proxy(reader, writer):
+        request_lines.append((await reader.readline()).decode())
+        while await reader.readline() not in (b"\r\n", b""):
+            pass
+        body = json.dumps({"choices": [{"message": {"content": "ok"}}]}).encode()
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+            b"Content-Length: %d\r\nConnection: close\r\n\r\n%s" % (len(body), body)
+        )
+        await writer.drain()
+        writer.close()
+
+    async def request_through_proxy():
+        server = await asyncio.start_server(proxy, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        monkeypatch.setenv("http_proxy", f"http://127.0.0.1:{port}")
+        try:
+            return await _http.chat_completion(
+                [], "model", 1.0, "key", "http://api.example.invalid/v1"
+            )
+        finally:
+            server.close()
+
+    for name in ("no_proxy", "NO_PROXY", "HTTP_PROXY"):
+        monkeypatch.delenv(name, raising=False)
+
+    completion = run_async(request_through_proxy())
+    assert completion["choices"][0]["message"]["content"] == "ok"
+    assert request_lines == [
+        "POST http://api.example.invalid/v1/chat/completions HTTP/1.1\r\n"
+    ]
+
+
+def test_batch_stream_dropped_midway_is_retried(monkeypatch):
+    attempts = []
+
+    def sse(content):
+        event = json.dumps({"choices": [{"delta": {"content": content}}]})
+        data = f"data: {event}\n\n".encode()
+        return b"%x\r\n%s\r\n" % (len(data), data)
+
+    async def server(reader, writer):
+        while await reader.readline() not in (b"\r\n", b""):
+            pass
+        attempts.append(True)
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+            b"Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n"
+        )
+        writer.write(sse('["(1) '))
+        if len(attempts) > 1:
+            writer.write(sse('一", "(2) 二"]') + b"0\r\n\r\n")
+        # the first reply is cut off in the middle of the chunked body
+        await writer.drain()
+        writer.close()
+
+    async def translate_batch():
+        listener = await asyncio.start_server(server, "127.0.0.1", 0)
+        port = listener.sockets[0].getsockname()[1]
+        translator = make_translator()
+        translator.api_base = f"http://127.0.0.1:{port}/v1"
+        try:
+            return await translator._async_translate(
+                ("(1) one\n\n(2) two", [], "key", "model"), json_array=True
+            )
+        finally:
+            listener.close()
+
+    for name in ("http_proxy", "HTTP_PROXY"):
+        monkeypatch.delenv(name, raising=False)
+
+    assert run_async(translate_batch()) == '["(1) 一", "(2) 二"]'
+    assert len(attempts) == 2
@@ -0,0 +1,56 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+from book_maker.loader.epub_loader import EPUBBookLoader
+from book_maker.utils import _get_background_loop, run_async
+
+
+class FakeProgressBar:
+    def __init__(self):
+        self.n = 0
+
+    def update(self, n):
+        self.n += n
+
+    def set_postfix_str(self, s):
+        pass
+
+
+def test_parallel_chapters_do_not_starve_the_default_executor():
+    loop = _get_background_loop()
+    default_executor = loop._default_executor
+    # aiohttp resolves host names in the default executor, leave it one thread
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=1))
+
+    async def resolve():
+        return await asyncio.get_running_loop().run_in_executor(None, str, "ok")
+
+    def process_chapter(chapter_data):
+        item = chapter_data[0]
+        # like translate_list, block on the shared loop until the lookup is done
+        return {"success": True, "processed_content": run_async(resolve()) + item.n}
+
+    loader = EPUBBookLoader.__new__(EPUBBookLoader)
+    loader._process_chapter_parallel = process_chapter
+    items = [
+        SimpleNamespace(file_name=f"{n}.html", content="", n=str(n)) for n in range(3)
+    ]
+    pbar = FakeProgressBar()
+    result = []
+    worker = threading.Thread(
+        target=lambda: result.extend(
+            loader._process_chapters_parallel([(item,) for item in items], 3, pbar)
+        ),
+        daemon=True,
+    )
+    try:
+        worker.start()
+        worker.join(timeout=10)
+    finally:
+        loop._default_executor = default_executor
+
+    assert not worker.is_alive(), "parallel chapters deadlocked"
+    assert [item.content for item in result] == ["ok0", "ok1", "ok2"]
+    assert pbar.n == 3